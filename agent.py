@@ -1,14 +1,19 @@
-import re
+import decimal
+import numbers
 import os
-import duckdb
-import pandas as pd
-from langchain_groq import ChatGroq
-from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+import threading
+from collections import OrderedDict
+from typing import Literal, Optional
+from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
 
+from kpis import get_db_connection
+
 load_dotenv()
 
+# Return query results as a pyarrow Table instead of a pandas DataFrame (skips a copy for large results)
+ARROW_RESULTS = os.getenv("CLOUDBOT_ARROW_RESULTS", "").lower() in ("1", "true", "yes")
+
 _llm = None
 
 def get_llm():
@@ -22,12 +27,12 @@ def get_llm():
     if api_key is None:
         return None
 
+    # Imported here: LangChain/Groq are slow to import and only needed once a question is asked
+    from langchain_groq import ChatGroq
+
     _llm = ChatGroq(model=model, api_key=api_key)
     return _llm
 
-def get_db_connection():
-    return duckdb.connect("cloudwalk.db", read_only=True)
-
 system_template = """
 You are a data analyst assistant. Your job is to translate natural language questions 
 into SQL queries for DuckDB, based on this table:
@@ -49,8 +54,15 @@ Columns:
  - is_weekday (STRING)
  - week_day_name (STRING)
 
+Answer with a JSON object with these keys:
+ - "sql": the SQL query, without markdown quotations
+ - "x_col": the result column for the chart's x axis (a category or date)
+ - "y_col": the numeric result column for the chart's y axis
+ - "hue_col": a result column that splits the data into series (e.g. entity -> PJ/PF), or null
+ - "chart": "line" for trends over time, "boxplot" for distributions, otherwise "bar"
+
 Rules
- - ONLY output SQL without markdown quotations.
+ - ONLY output the JSON object.
  - Do NOT add explanation.
  - Use valid DuckDB SQL.
  - Use the column `amount_transacted` for monetary aggregations (there is no `amount` column).
@@ -59,22 +71,128 @@ Rules
  - When asked something "by x and by y", show both.
 """
 
-prompt = PromptTemplate(
-    template=system_template + "\nQuestion: {question}\nSQL:",
-    input_variables=["question"]
-)
+prompt_template = system_template + "\nQuestion: {question}\nJSON:"
+
+class SqlPlan(BaseModel):
+    """The LLM's answer: the SQL to run and how to chart its result.
+
+    Only `sql` is required; missing or unknown chart hints are filled in by `_chart_plan`.
+    """
+    sql: str = Field(description="DuckDB SQL query answering the question")
+    x_col: Optional[str] = Field(default=None, description="Result column for the x axis")
+    y_col: Optional[str] = Field(default=None, description="Numeric result column for the y axis")
+    hue_col: Optional[str] = Field(default=None, description="Result column splitting the data into series")
+    chart: Literal["bar", "line", "boxplot"] = Field(default="bar", description="Suggested chart type")
+
+    @field_validator("chart", mode="before")
+    @classmethod
+    def _lenient_chart(cls, value):
+        """Accept any casing; null or unknown chart types fall back to "bar"."""
+        value = str(value or "").strip().lower()
+        return value if value in ("bar", "line", "boxplot") else "bar"
+
+# Generated plans keyed by normalized question, so repeated questions skip the LLM round-trip
+_SQL_CACHE_SIZE = 256
+_sql_cache: "OrderedDict[str, SqlPlan]" = OrderedDict()
+_sql_cache_lock = threading.Lock()
+
+def _normalize_question(question: str) -> str:
+    """Cache key for a question: case-folded, whitespace collapsed, trailing punctuation dropped."""
+    return " ".join(question.casefold().split()).rstrip("?!.;: ")
+
+def _remember_plan(question: str, plan: "SqlPlan"):
+    """Cache a plan once its SQL has run successfully, so failing queries are regenerated."""
+    key = _normalize_question(question)
+    with _sql_cache_lock:
+        _sql_cache[key] = plan
+        _sql_cache.move_to_end(key)
+        if len(_sql_cache) > _SQL_CACHE_SIZE:
+            _sql_cache.popitem(last=False)
 
 # We will build the pipeline at call time because the LLM is created lazily
-def _generate_sql_from_llm(question: str):
+def _generate_plan_from_llm(question: str):
+    """Return `(plan, error)`; one JSON-mode LLM call yields both the SQL and the chart hints."""
+    key = _normalize_question(question)
+    with _sql_cache_lock:
+        if key in _sql_cache:
+            _sql_cache.move_to_end(key)
+            return _sql_cache[key], None
+
     llm = get_llm()
-    sql_generator = prompt | llm | StrOutputParser()
-    raw = sql_generator.invoke({"question": question})
-    print(raw)
-    return raw, None
+    if llm is None:
+        return None, "❌ GROQ_API_KEY is not set. Add it to a `.env` file at the repository root."
+    from langchain_core.prompts import PromptTemplate
+
+    prompt = PromptTemplate(template=prompt_template, input_variables=["question"])
+    plan_generator = prompt | llm.with_structured_output(SqlPlan, method="json_mode")
+    try:
+        plan = plan_generator.invoke({"question": question})
+    except Exception as e:
+        return None, f"❌ LLM Error: {str(e)}"
+    print(plan)
+    return plan, None
+
+def numeric_columns(result) -> list:
+    """Names of the numeric (integer, float or decimal) columns of a DataFrame or pyarrow Table."""
+    if hasattr(result, "select_dtypes"):
+        return list(result.select_dtypes(include=['number']).columns)
+    import pyarrow as pa
+
+    return [
+        f.name for f in result.schema
+        if pa.types.is_integer(f.type) or pa.types.is_floating(f.type) or pa.types.is_decimal(f.type)
+    ]
+
+def _chart_plan(plan: Optional[SqlPlan], sql: str, result) -> SqlPlan:
+    """Return `plan` if its X column exists and its Y column is numeric in `result`, otherwise guess them.
 
-def run_query(question: str):
+    The guess (for raw SQL, or when the LLM names a column the query doesn't return or
+    a text Y column) is: first column as X, first numeric column as Y, first remaining
+    column as hue.
+    """
+    cols = list(result.columns) if hasattr(result, "select_dtypes") else result.column_names
+    nums = numeric_columns(result)
+    if plan is not None and plan.x_col in cols and plan.y_col in nums:
+        if plan.hue_col not in cols or plan.hue_col in (plan.x_col, plan.y_col):
+            plan = plan.model_copy(update={"hue_col": None})
+        return plan
+
+    x_col = cols[0]  # First column is usually X (Date/Category)
+    y_col = nums[0] if len(nums) > 0 else (cols[1] if len(cols) > 1 else cols[0])
+    remaining = [c for c in cols if c not in [x_col, y_col]]
+    hue_col = remaining[0] if remaining else None
+    chart = plan.chart if plan is not None else "bar"
+    return SqlPlan(sql=sql, x_col=x_col, y_col=y_col, hue_col=hue_col, chart=chart)
+
+def _scalar_result(result):
+    """Return `(column, value)` if `result` is a single numeric cell, otherwise None."""
+    if hasattr(result, "num_rows"):  # pyarrow Table
+        if result.num_rows != 1 or result.num_columns != 1:
+            return None
+        column, value = result.column_names[0], result.column(0)[0].as_py()
+    else:
+        if result.shape != (1, 1):
+            return None
+        column, value = result.columns[0], result.iat[0, 0]
+        value = value.item() if hasattr(value, "item") else value  # NumPy scalar -> Python
+    if isinstance(value, decimal.Decimal):  # Arrow DECIMAL/HUGEINT, e.g. SUM of an integer column
+        value = float(value)
+    if isinstance(value, bool) or not isinstance(value, numbers.Number) or value != value:  # NaN is NULL
+        return None
+    return column, value
+
+def run_query(question: str, con=None):
     """Generate SQL from the LLM (or accept raw SQL), run it in DuckDB, return results.
 
+    Returns `(sql, result, plan)`. `result` is a pandas DataFrame, or a pyarrow Table when
+    `CLOUDBOT_ARROW_RESULTS` is set, or an error message string (then `plan` is None).
+    A result that is a single numeric cell (e.g. "what is the total TPV?") is returned as
+    a plain Python number instead. `plan` is a `SqlPlan` whose x/y/hue columns exist in
+    `result` (for a number, x_col and y_col are its column name).
+
+    `con` is an open DuckDB connection to run the query on; defaults to the shared
+    read-only connection from `kpis.get_db_connection`.
+
     Behavior:
     - If `question` starts with `SQL:` (case-insensitive), treat the rest as raw SQL and run it.
     - Otherwise, attempt to generate SQL with the LLM. If `GROQ_API_KEY` is not present,
@@ -82,16 +200,17 @@ def run_query(question: str):
     """
 
     # Support raw SQL passthrough for development and testing
+    plan = None
     if isinstance(question, str) and question.strip().lower().startswith("sql:"):
         sql = question.strip()[len("sql:"):].strip()
     else:
-        raw, err = _generate_sql_from_llm(question)
+        plan, err = _generate_plan_from_llm(question)
         if err is not None:
-            return "", err
-        if raw is None:
-            return "", "❌ LLM did not return any SQL"
+            return "", err, None
+        if plan is None or not plan.sql.strip():
+            return "", "❌ LLM did not return any SQL", None
 
-        sql = str(raw).strip()
+        sql = plan.sql.strip()
 
     # This is a hardcoded removal of the markdown quotations. Since I made it explicit in the system prompt, 
     # it is not necessary to have it here anymore. Leaving it in case I notice its better to state it here 
@@ -107,13 +226,32 @@ def run_query(question: str):
 
     # Final whitespace cleanup
     sql = sql.strip('\n')
-    con = duckdb.connect("cloudwalk.db", read_only=True)
+    if con is None:
+        con = get_db_connection()
+    # A cursor per query keeps concurrent sessions on the shared connection apart
+    cur = con.cursor()
     try:
-        # Use pandas to get a DataFrame result for easier display/plotting
-        df = pd.read_sql_query(sql, con)
-        return sql, df
+        cur.execute(sql)
+        if ARROW_RESULTS:
+            # to_arrow_table() replaced fetch_arrow_table() in newer DuckDB releases
+            fetch_arrow = getattr(cur, "to_arrow_table", None) or cur.fetch_arrow_table
+            result = fetch_arrow()
+        else:
+            # DuckDB builds the pandas DataFrame natively, for easier display/plotting
+            result = cur.fetch_df()
     except Exception as e:
         # Return the SQL and the error message so the UI can show it
-        return sql, f"❌ SQL Error: {str(e)}"
+        return sql, f"❌ SQL Error: {str(e)}", None
     finally:
-        con.close()
\ No newline at end of file
+        cur.close()
+
+    if plan is not None:
+        _remember_plan(question, plan)
+
+    scalar = _scalar_result(result)
+    if scalar is not None:
+        column, value = scalar
+        chart = plan.chart if plan is not None else "bar"
+        return sql, value, SqlPlan(sql=sql, x_col=column, y_col=column, chart=chart)
+
+    return sql, result, _chart_plan(plan, sql, result)
\ No newline at end of file
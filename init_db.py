@@ -1,5 +1,4 @@
 import duckdb
-import pandas as pd
 from pathlib import Path
 
 DATA_PATH = Path("data/operational_intelligence_transactions_db.csv")
@@ -8,24 +7,27 @@ DB_PATH = Path("cloudwalk.db")
 def init_db():
     print("🚀 Creating DuckDB database...")
 
-    # The CSV uses semicolons as delimiters, so specify sep=';'
-    df = pd.read_csv(DATA_PATH, sep=';')
-
-    # Try to parse a date column if present
-    if 'day' in df.columns:
-        try:
-            df['day'] = pd.to_datetime(df['day'], errors='coerce')
-        except Exception:
-            pass
-
     con = duckdb.connect(str(DB_PATH))
 
+    con.execute("DROP TABLE IF EXISTS tpv_daily;")
     con.execute("DROP TABLE IF EXISTS transactions;")
 
-    con.execute("""
+    # Let DuckDB parse the CSV directly into the table (no pandas round-trip).
+    # The file uses semicolons as delimiters and dd/mm/yyyy dates.
+    con.execute(f"""
         CREATE TABLE transactions AS
-        SELECT * FROM df;
+        SELECT * FROM read_csv_auto('{DATA_PATH.as_posix()}', delim=';', header=true, dateformat='%d/%m/%Y');
+    """)
+
+    # Daily TPV pre-aggregated once at load time, so KPI lookups are point queries
+    con.execute("""
+        CREATE TABLE tpv_daily AS
+        SELECT CAST(day AS DATE) AS day_date,
+               SUM(amount_transacted)::DOUBLE AS tpv
+        FROM transactions
+        GROUP BY 1;
     """)
+    con.execute("CREATE INDEX idx_tpv_daily_date ON tpv_daily(day_date);")
 
     con.close()
 
@@ -20,35 +20,99 @@ from __future__ import annotations
 
 import argparse
 import datetime as dt
+import functools
 import json
 import os
-from typing import Dict, Optional
+import threading
+from typing import Dict, List, Optional, Tuple
 
 import duckdb
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 DB_PATH = os.getenv("CLOUDWALK_DB", "cloudwalk.db")
 
+_con: Optional[duckdb.DuckDBPyConnection] = None
+_con_lock = threading.Lock()
 
-def _get_tpv_by_date(con: duckdb.DuckDBPyConnection) -> pd.DataFrame:
-    """Return a DataFrame with columns `day_date` (date) and `tpv` (sum of amount_transacted)."""
-    sql = """
-    SELECT CAST(day AS DATE) AS day_date,
-           SUM(amount_transacted) AS tpv
-    FROM transactions
-    GROUP BY day_date
-    ORDER BY day_date
+# Reused by every alert so repeated sends keep the HTTPS connection alive.
+# urllib3 only retries POSTs on connection errors, so a delivered alert is never resent.
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_maxsize=2, max_retries=Retry(total=2, backoff_factor=0.2)))
+
+
+def get_db_connection() -> duckdb.DuckDBPyConnection:
+    """Return a shared read-only connection to `DB_PATH`, opened on first use.
+
+    While it is open DuckDB locks the file, so `init_db.py` cannot rebuild the
+    database until this process exits.
+    """
+    global _con
+    with _con_lock:
+        if _con is None:
+            _con = duckdb.connect(DB_PATH, read_only=True)
+        return _con
+
+
+def _has_table(con: duckdb.DuckDBPyConnection, name: str) -> bool:
+    sql = "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = ?"
+    return con.execute(sql, [name]).fetchone()[0] > 0
+
+
+def _get_tpv_by_dates(con: duckdb.DuckDBPyConnection, dates: List[dt.date]) -> Dict[dt.date, float]:
+    """Return {day_date: tpv} (sum of amount_transacted) for the given dates only.
+
+    Reads the `tpv_daily` table built by `init_db.py`; databases created before it
+    existed fall back to aggregating `transactions`. Dates without transactions
+    are absent from the result.
+    """
+    placeholders = ", ".join("?" for _ in dates)
+    if _has_table(con, "tpv_daily"):
+        sql = f"""
+        SELECT day_date, tpv
+        FROM tpv_daily
+        WHERE day_date IN ({placeholders})
+        """
+    else:
+        sql = f"""
+        SELECT CAST(day AS DATE) AS day_date,
+               SUM(amount_transacted)::DOUBLE AS tpv
+        FROM transactions
+        WHERE CAST(day AS DATE) IN ({placeholders})
+        GROUP BY day_date
+        """
+    rows = con.execute(sql, list(dates)).fetchall()
+    # both queries yield (DATE, DOUBLE) pairs, which the driver already returns as (date, float)
+    return dict(rows)
+
+
+def _query_tpv(con: duckdb.DuckDBPyConnection, dates: Tuple[dt.date, ...]) -> Dict[dt.date, float]:
+    # DuckDB connections are not thread-safe; a cursor gives this call its own handle
+    cur = con.cursor()
+    try:
+        return _get_tpv_by_dates(cur, list(dates))
+    finally:
+        cur.close()
+
+
+@functools.lru_cache(maxsize=32)
+def _load_tpv(dates: Tuple[dt.date, ...]) -> Dict[dt.date, float]:
+    """Cached `_get_tpv_by_dates` on the shared connection.
+
+    The database cannot change while that connection holds its lock, so dates are the whole key.
     """
-    df = con.execute(sql).fetchdf()
-    # ensure day_date is datetime.date
-    df["day_date"] = pd.to_datetime(df["day_date"]).dt.date
-    return df
+    return _query_tpv(get_db_connection(), dates)
 
 
-def compute_daily_tpv_summary(target_date: Optional[dt.date] = None) -> Dict[str, object]:
+def compute_daily_tpv_summary(
+    target_date: Optional[dt.date] = None, con: Optional[duckdb.DuckDBPyConnection] = None
+) -> Dict[str, object]:
     """Compute TPV and variations for target_date vs D-1, D-7, D-30.
 
+    `con` is an open DuckDB connection to query; defaults to this module's shared one
+    (only lookups on the shared connection are cached).
+
     Returns a dictionary with keys:
       - date: target_date
       - tpv: float
@@ -58,22 +122,21 @@ def compute_daily_tpv_summary(target_date: Optional[dt.date] = None) -> Dict[str
     if target_date is None:
         target_date = dt.date.today()
 
-    con = duckdb.connect(DB_PATH)
-    try:
-        df = _get_tpv_by_date(con)
-    finally:
-        con.close()
+    d1 = target_date - dt.timedelta(days=1)
+    d7 = target_date - dt.timedelta(days=7)
+    d30 = target_date - dt.timedelta(days=30)
 
-    # convert to dict for quick lookup
-    tpv_map = {row["day_date"]: float(row["tpv"]) for _, row in df.iterrows()}
+    # only the four dates we need, cached for the shared connection
+    dates = (target_date, d1, d7, d30)
+    if con is None:
+        tpv_map = _load_tpv(dates)
+    else:
+        tpv_map = _query_tpv(con, dates)
 
     def get_tpv(d: dt.date) -> Optional[float]:
         return tpv_map.get(d)
 
     tpv = get_tpv(target_date)
-    d1 = target_date - dt.timedelta(days=1)
-    d7 = target_date - dt.timedelta(days=7)
-    d30 = target_date - dt.timedelta(days=30)
 
     tpv_d1 = get_tpv(d1)
     tpv_d7 = get_tpv(d7)
@@ -103,17 +166,38 @@ def compute_daily_tpv_summary(target_date: Optional[dt.date] = None) -> Dict[str
     return res
 
 
+# bound str.format methods, created once instead of per call
+_format_currency = "R$ {:,.2f}".format
+_format_pct = "{:+.2%}".format  # sign, x100 and '%' handled by the format spec
+
+
 def format_currency(x: Optional[float]) -> str:
     if x is None:
         return "N/A"
-    return f"R$ {x:,.2f}"
+    return _format_currency(x)
 
 
 def format_pct(x: Optional[float]) -> str:
     if x is None:
         return "N/A"
-    sign = "+" if x >= 0 else ""
-    return f"{sign}{x*100:.2f}%"
+    return _format_pct(x)
+
+
+def fired_triggers(
+    summary: Dict[str, object], low: float, high: float, inclusive: bool = False
+) -> Dict[str, float]:
+    """Return {period: pct} for the D-1/D-7/D-30 variations outside the (low, high) band.
+
+    Missing variations never fire. With `inclusive=True` a variation equal to a bound fires too.
+    """
+    fired = {}
+    for period in ("d1", "d7", "d30"):
+        pct = summary.get(f"pct_vs_{period}")
+        if pct is None:
+            continue
+        if pct < low or pct > high or (inclusive and (pct == low or pct == high)):
+            fired[period] = pct
+    return fired
 
 
 def build_alert_message(summary: Dict[str, object], triggers: Dict[str, float]) -> str:
@@ -142,7 +226,7 @@ def send_webhook_alert(webhook_url: str, message: str, extra: Optional[dict] = N
         "summary": (extra or {}),
     }
     try:
-        resp = requests.post(webhook_url, json=payload, timeout=10)
+        resp = _session.post(webhook_url, json=payload, timeout=10)
         ok = 200 <= resp.status_code < 300
         if verbose:
             return ok, resp.status_code, resp.text
@@ -175,13 +259,8 @@ def main():
 
     triggers = {"d1": args.threshold, "d7": args.threshold, "d30": args.threshold}
 
-    # Determine if any trigger fired
-    fired = []
-    for key in ("d1", "d7", "d30"):
-        pct = summary.get(f"pct_vs_{key}")
-        thr = triggers[key]
-        if pct is not None and abs(pct) >= thr:
-            fired.append(key)
+    # Determine if any trigger fired (|pct| >= threshold)
+    fired = list(fired_triggers(summary, -args.threshold, args.threshold, inclusive=True))
 
     # Print summary
     print(json.dumps(summary, indent=2))
@@ -1,11 +1,9 @@
 import streamlit as st
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from matplotlib.ticker import FuncFormatter
 import os
-import matplotlib.dates as mdates
-from agent import run_query
+import hashlib
+import numbers
+from agent import numeric_columns, run_query
 import kpis
 
 st.set_page_config(page_title="Cloudbot", layout="wide")
@@ -64,15 +62,9 @@ with st.sidebar:
 
         # Alert Logic
         fired_reasons = []
-        check_periods = ["d1", "d7", "d30"]
-        
-        for period in check_periods:
-            pct = summary.get(f"pct_vs_{period}")
-            if pct is not None:
-                if pct < thresh_low:
-                    fired_reasons.append(f"{period} (Drop {kpis.format_pct(pct)})")
-                elif pct > thresh_high:
-                    fired_reasons.append(f"{period} (Spike {kpis.format_pct(pct)})")
+        for period, pct in kpis.fired_triggers(summary, thresh_low, thresh_high).items():
+            kind = "Drop" if pct < thresh_low else "Spike"
+            fired_reasons.append(f"{period} ({kind} {kpis.format_pct(pct)})")
 
         if fired_reasons:
             st.error(f"⚠️ Triggers: {', '.join(fired_reasons)}")
@@ -95,10 +87,196 @@ with st.sidebar:
             st.info("✅ No alerts fired.")
 
 
-# Set theme and palette
-sns.set_theme(style="whitegrid")
+# Plotting libraries are imported inside the chart helpers, so they are only loaded
+# once there is something to plot (keeps startup fast)
 TEXT_COLOR = "#ffffff" # Force white for charts on dark backgrounds
 
+
+def _df_key(df: pd.DataFrame) -> str:
+    """Content hash of the plotted columns (values and names), used to detect chart changes."""
+    h = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    h.update(repr(list(df.columns)).encode())
+    return h.hexdigest()
+
+
+def _sorts(col: pd.Series) -> bool:
+    """Numeric and date categories are shown in sorted order, text ones in order of appearance."""
+    return pd.api.types.is_numeric_dtype(col) or pd.api.types.is_datetime64_any_dtype(col)
+
+
+def _categories(col: pd.Series) -> list:
+    values = col.dropna().unique()
+    return sorted(values) if _sorts(col) else list(values)
+
+
+def _dodged_bars(ax, pivot: pd.DataFrame):
+    """Grouped bars: one group per row of `pivot`, one bar (and legend entry) per column."""
+    import seaborn as sns
+
+    colors = sns.color_palette("crest", len(pivot.columns))
+    width = 0.8 / len(pivot.columns)
+    for j, (name, color) in enumerate(zip(pivot.columns, colors)):
+        positions = [i - 0.4 + width * (j + 0.5) for i in range(len(pivot))]
+        ax.bar(positions, pivot[name].values, width=width, color=color, label=str(name))
+    ax.set_xticks(range(len(pivot)), [str(v) for v in pivot.index])
+    ax.set_xlabel(pivot.index.name)
+    ax.legend()
+
+
+def _boxes(ax, data, positions, colors, width):
+    boxes = ax.boxplot(
+        data, positions=list(positions), widths=width, patch_artist=True, manage_ticks=False,
+        boxprops=dict(linewidth=0.8, edgecolor=TEXT_COLOR), medianprops=dict(linewidth=0.8, color=TEXT_COLOR),
+        whiskerprops=dict(linewidth=0.8, color=TEXT_COLOR), capprops=dict(linewidth=0.8, color=TEXT_COLOR),
+        flierprops=dict(markersize=2, markeredgecolor=TEXT_COLOR),
+    )
+    for box, color in zip(boxes["boxes"], colors):
+        box.set_facecolor(color)
+
+
+def _style(ax):
+    """Dark-mode styling for the chart axes; needs re-applying after every `ax.clear()`."""
+    ax.set_facecolor("none")
+
+    # Tiny Fonts & Styling
+    ax.tick_params(axis='x', colors=TEXT_COLOR, labelsize=6) 
+    ax.tick_params(axis='y', colors=TEXT_COLOR, labelsize=6)
+    ax.xaxis.label.set_size(6)
+    ax.yaxis.label.set_size(6)
+    ax.xaxis.label.set_color(TEXT_COLOR)
+    ax.yaxis.label.set_color(TEXT_COLOR)
+
+    for spine in ax.spines.values():
+        spine.set_color(TEXT_COLOR)
+        spine.set_linewidth(0.5)
+    ax.grid(True, linestyle='--', alpha=0.2, linewidth=0.5)
+
+
+def _render_chart(ax, df: pd.DataFrame, chart_type: str, x_col, y_col, hue_col):
+    """Redraw the chart on `ax` and return an optional caption to show under it."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from matplotlib.ticker import FuncFormatter
+    from matplotlib.patches import Patch
+    import matplotlib.dates as mdates
+
+    note = None
+    ax.clear()
+    _style(ax)
+
+    # PLOTTING LOGIC
+    # Drawn with matplotlib directly: the inputs are already aggregated query results,
+    # so Seaborn's estimator/bootstrap pass would only add cost.
+    if chart_type == "Bar":
+        # If we have a Hue (Legend), use it to group bars
+        if hue_col:
+            if df.duplicated(subset=[x_col, hue_col]).any():
+                pivot = df.pivot_table(index=x_col, columns=hue_col, values=y_col, aggfunc="mean")
+            else:
+                # Already one row per (x, hue), as GROUP BY results are: just reshape, no aggregation
+                pivot = df.pivot(index=x_col, columns=hue_col, values=y_col)
+            # Same group and legend order whichever path built the pivot
+            pivot = pivot.reindex(index=_categories(df[x_col]), columns=_categories(df[hue_col]))
+            _dodged_bars(ax, pivot)
+            ax.set_ylabel(y_col)
+        else:
+            # Standard Bar Plot
+            if df[x_col].nunique() > 20 and pd.api.types.is_numeric_dtype(df[y_col]):
+                top = df.groupby(x_col)[y_col].sum().nlargest(20)
+                ax.barh(range(len(top)), top.values, color=sns.color_palette("crest", len(top)))
+                ax.set_yticks(range(len(top)), [str(v) for v in top.index])
+                ax.invert_yaxis()
+                for i, v in enumerate(top.values):
+                    ax.text(v, i, f" {v:,.0f}", va='center', fontsize=6, color=TEXT_COLOR)
+            else:
+                means = df.groupby(x_col, sort=_sorts(df[x_col]))[y_col].mean()
+                ax.bar(range(len(means)), means.values, color=sns.color_palette("crest", len(means)))
+                ax.set_xticks(range(len(means)), [str(v) for v in means.index])
+                ax.set_xlabel(x_col)
+                ax.set_ylabel(y_col)
+        
+        if df[x_col].nunique() > 5:
+            plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
+
+    elif chart_type == "Line":
+        # One line per hue value (e.g. PJ vs PF); repeated x values are averaged
+        groups = df.groupby(hue_col, sort=False) if hue_col else [(None, df)]
+        colors = sns.color_palette("crest", len(groups))
+        for color, (name, group) in zip(colors, groups):
+            line = group.groupby(x_col)[y_col].mean()
+            ax.plot(line.index, line.values, marker='o', color=color, lw=1.5, markersize=4, label=name)
+        ax.set_xlabel(x_col)
+        ax.set_ylabel(y_col)
+        if hue_col:
+            ax.legend()
+        
+        if pd.api.types.is_datetime64_any_dtype(df[x_col]):
+            locator = mdates.AutoDateLocator()
+            formatter = mdates.ConciseDateFormatter(locator)
+            ax.xaxis.set_major_locator(locator)
+            ax.xaxis.set_major_formatter(formatter)
+        plt.setp(ax.get_xticklabels(), rotation=30, ha='right', color=TEXT_COLOR)
+
+    elif chart_type == "Boxplot":
+        is_datetime = pd.api.types.is_datetime64_any_dtype(df[x_col])
+        high_cardinality = df[x_col].nunique() > 20
+        
+        if hue_col:
+            x_values = _categories(df[x_col])
+            hue_values = _categories(df[hue_col])
+            colors = sns.color_palette("crest", len(hue_values))
+            width = 0.8 / len(hue_values)
+            for j, (hue_value, color) in enumerate(zip(hue_values, colors)):
+                subset = df[df[hue_col] == hue_value]
+                data = [subset.loc[subset[x_col] == x, y_col].dropna() for x in x_values]
+                positions = [i - 0.4 + width * (j + 0.5) for i in range(len(x_values))]
+                _boxes(ax, data, positions, [color] * len(data), width * 0.9)
+            ax.set_xticks(range(len(x_values)), [str(v) for v in x_values])
+            ax.legend(handles=[Patch(facecolor=c, label=str(v)) for v, c in zip(hue_values, colors)])
+            ax.set_xlabel(x_col)
+            plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
+        elif is_datetime or high_cardinality:
+            _boxes(ax, [df[y_col].dropna()], [0], sns.color_palette("crest", 1), 0.8)
+            ax.set_xticks([])
+            note = f"ℹ️ Showing overall distribution of {y_col}."
+        else:
+            x_values = _categories(df[x_col])
+            data = [df.loc[df[x_col] == x, y_col].dropna() for x in x_values]
+            _boxes(ax, data, range(len(data)), sns.color_palette("crest", len(data)), 0.8)
+            ax.set_xticks(range(len(x_values)), [str(v) for v in x_values])
+            ax.set_xlabel(x_col)
+            plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
+        ax.set_ylabel(y_col)
+
+    # CUSTOM LEGEND STYLING (Crucial for Dark Mode)
+    if hue_col:
+        leg = ax.get_legend()
+        if leg:
+            # Clean up legend title and text
+            leg.set_title(hue_col)
+            leg.get_title().set_color(TEXT_COLOR)
+            leg.get_title().set_fontsize(6)
+            
+            # Style the legend box to be transparent but readable
+            leg.get_frame().set_facecolor("none")
+            leg.get_frame().set_edgecolor(TEXT_COLOR)
+            leg.get_frame().set_linewidth(0.3)
+            
+            for text in leg.get_texts():
+                text.set_color(TEXT_COLOR)
+                text.set_fontsize(6)
+
+    # Format Y Axis (Thousands)
+    if len(df.select_dtypes(include=['number']).columns) > 0:
+        ax.yaxis.set_major_formatter(FuncFormatter(lambda x, pos: f"{x:,.0f}"))
+
+    ax.figure.tight_layout()
+    ax.xaxis.label.set_size(6)
+    ax.yaxis.label.set_size(6)
+
+    return note
+
+
 IMAGE_PATH = os.getenv("APP_LOGO_PATH", "")
 if not IMAGE_PATH:
     IMAGE_PATH = "logo.png"
@@ -128,9 +306,10 @@ question = st.text_input(
 if st.button("Run Query"):
     if question:
         with st.spinner("Generating SQL..."):
-            sql, result = run_query(question)
+            sql, result, plan = run_query(question)
             st.session_state['last_sql'] = sql
             st.session_state['last_result'] = result
+            st.session_state['last_plan'] = plan
             st.session_state['query_ran'] = True
     else:
         st.warning("Please enter a question.")
@@ -139,6 +318,7 @@ if st.button("Run Query"):
 if st.session_state.get('query_ran'):
     sql = st.session_state.get('last_sql')
     result = st.session_state.get('last_result')
+    plan = st.session_state.get('last_plan')
 
     st.subheader("Generated SQL")
     st.code(sql, language="sql")
@@ -146,130 +326,77 @@ if st.session_state.get('query_ran'):
     st.subheader("Results")
     if isinstance(result, str):
         st.error(result)
+    elif isinstance(result, numbers.Number):
+        # Single-value answers (e.g. "what is the total TPV?") need no table or chart
+        st.metric(plan.y_col, f"{result:,.2f}" if isinstance(result, float) else f"{result:,}")
     else:
-        df: pd.DataFrame = result
-        st.dataframe(df)
+        # A pandas DataFrame, or a pyarrow Table when CLOUDBOT_ARROW_RESULTS is set
+        is_arrow = not isinstance(result, pd.DataFrame)
+        st.dataframe(result)
 
-        if not df.empty and df.shape[1] >= 1:
+        n_rows, n_cols = (result.num_rows, result.num_columns) if is_arrow else result.shape
+        # Charts need a numeric Y column; text-only results are shown as a table only
+        if n_rows > 0 and n_cols >= 1 and plan.y_col in numeric_columns(result):
             st.markdown("---")
             
             viz_col1, viz_col2 = st.columns([1, 1])
             with viz_col1:
                 st.subheader("Visualization")
             with viz_col2:
+                # Default to the chart type suggested alongside the SQL
+                chart_types = ["Bar", "Line", "Boxplot"]
                 chart_type = st.radio(
                     "Chart Type",
-                    ["Bar", "Line", "Boxplot"],
+                    chart_types,
+                    index=[c.lower() for c in chart_types].index(plan.chart),
                     horizontal=True,
                     label_visibility="collapsed"
                 )
 
             try:
-                # COLUMN DETECTION
-                cols = df.columns
-                x_col = cols[0]  # First column is usually X (Date/Category)
-                
-                # Find Numeric Column (Y Axis)
-                nums = df.select_dtypes(include=['number']).columns
-                y_col = nums[0] if len(nums) > 0 else (cols[1] if len(cols) > 1 else cols[0])
-                
-                # Find Hue Column (The "Legend" column, e.g., 'client_type' -> PJ/PF)
-                # It is any column that is NOT x_col and NOT y_col
-                hue_col = None
-                remaining = [c for c in cols if c not in [x_col, y_col]]
-                if remaining:
-                    hue_col = remaining[0] # Use the first extra column as the grouper
-
-                # FIGURE SETUP
-                fig, ax = plt.subplots(figsize=(8, 3))
-                fig.patch.set_alpha(0)
-                ax.set_facecolor("none")
-
-                # Tiny Fonts & Styling
-                ax.tick_params(axis='x', colors=TEXT_COLOR, labelsize=6) 
-                ax.tick_params(axis='y', colors=TEXT_COLOR, labelsize=6)
-                ax.xaxis.label.set_size(6)
-                ax.yaxis.label.set_size(6)
-                ax.xaxis.label.set_color(TEXT_COLOR)
-                ax.yaxis.label.set_color(TEXT_COLOR)
-
-                for spine in ax.spines.values():
-                    spine.set_color(TEXT_COLOR)
-                    spine.set_linewidth(0.5)
-                ax.grid(True, linestyle='--', alpha=0.2, linewidth=0.5)
-
-                # PLOTTING LOGIC
-                if chart_type == "Bar":
-                    # If we have a Hue (Legend), use it to group bars
-                    if hue_col:
-                        sns.barplot(data=df, x=x_col, y=y_col, hue=hue_col, ax=ax, palette="crest")
-                    else:
-                        # Standard Bar Plot
-                        if df[x_col].nunique() > 20 and pd.api.types.is_numeric_dtype(df[y_col]):
-                            top = df.groupby(x_col)[y_col].sum().nlargest(20)
-                            sns.barplot(x=top.values, y=top.index, ax=ax, palette="crest")
-                            for i, v in enumerate(top.values):
-                                ax.text(v, i, f" {v:,.0f}", va='center', fontsize=6, color=TEXT_COLOR)
-                        else:
-                            sns.barplot(data=df, x=x_col, y=y_col, ax=ax, palette="crest")
-                    
-                    if df[x_col].nunique() > 5:
-                        plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
-
-                elif chart_type == "Line":
-                    df_sorted = df.sort_values(by=x_col)
-                    
-                    # Pass 'hue' if it exists to draw multiple lines (e.g. PJ vs PF)
-                    sns.lineplot(data=df_sorted, x=x_col, y=y_col, hue=hue_col, ax=ax, marker='o', palette="crest", lw=1.5, markersize=4)
-                    
-                    if pd.api.types.is_datetime64_any_dtype(df_sorted[x_col]):
-                        locator = mdates.AutoDateLocator()
-                        formatter = mdates.ConciseDateFormatter(locator)
-                        ax.xaxis.set_major_locator(locator)
-                        ax.xaxis.set_major_formatter(formatter)
-                    plt.setp(ax.get_xticklabels(), rotation=30, ha='right', color=TEXT_COLOR)
-
-                elif chart_type == "Boxplot":
-                    is_datetime = pd.api.types.is_datetime64_any_dtype(df[x_col])
-                    high_cardinality = df[x_col].nunique() > 20
-                    
-                    if hue_col:
-                         sns.boxplot(data=df, x=x_col, y=y_col, hue=hue_col, ax=ax, palette="crest", linewidth=0.8, fliersize=2)
-                         plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
-                    elif is_datetime or high_cardinality:
-                        sns.boxplot(data=df, x=None, y=y_col, ax=ax, palette="crest", linewidth=0.8, fliersize=2)
-                        st.caption(f"ℹ️ Showing overall distribution of {y_col}.")
-                    else:
-                        sns.boxplot(data=df, x=x_col, y=y_col, ax=ax, palette="crest", linewidth=0.8, fliersize=2)
-                        plt.setp(ax.get_xticklabels(), rotation=45, ha='right', color=TEXT_COLOR)
-
-                # CUSTOM LEGEND STYLING (Crucial for Dark Mode)
-                if hue_col:
-                    leg = ax.get_legend()
-                    if leg:
-                        # Clean up legend title and text
-                        leg.set_title(hue_col)
-                        leg.get_title().set_color(TEXT_COLOR)
-                        leg.get_title().set_fontsize(6)
-                        
-                        # Style the legend box to be transparent but readable
-                        leg.get_frame().set_facecolor("none")
-                        leg.get_frame().set_edgecolor(TEXT_COLOR)
-                        leg.get_frame().set_linewidth(0.3)
-                        
-                        for text in leg.get_texts():
-                            text.set_color(TEXT_COLOR)
-                            text.set_fontsize(6)
-
-                # Format Y Axis (Thousands)
-                if len(df.select_dtypes(include=['number']).columns) > 0:
-                    ax.yaxis.set_major_formatter(FuncFormatter(lambda x, pos: f"{x:,.0f}"))
-                
-                plt.tight_layout()
-                ax.xaxis.label.set_size(6)
-                ax.yaxis.label.set_size(6)
-                
+                # Columns chosen by the LLM with the SQL (or guessed from the result by the agent)
+                x_col, y_col, hue_col = plan.x_col, plan.y_col, plan.hue_col
+                plot_cols = list(dict.fromkeys(c for c in (x_col, y_col, hue_col) if c is not None))
+
+                # Only the plotted columns of an Arrow result are converted to pandas
+                if is_arrow:
+                    import pyarrow as pa
+
+                    table = result.select(plot_cols)
+                    # DECIMAL columns (e.g. SUM of an integer column) would become Python Decimal objects
+                    table = table.cast(pa.schema([
+                        pa.field(f.name, pa.float64()) if pa.types.is_decimal(f.type) else f for f in table.schema
+                    ]))
+                    df = table.to_pandas(date_as_object=False)
+                else:
+                    df = result
+
+                # One Figure per session, reused across reruns. It is only redrawn when the
+                # chart changes, not on reruns triggered elsewhere (e.g. the KPI sidebar).
+                # Created outside pyplot so it is freed with the session instead of staying
+                # registered in pyplot's global figure manager.
+                if 'fig' not in st.session_state:
+                    import seaborn as sns
+                    from matplotlib.figure import Figure
+
+                    # Set theme and palette
+                    sns.set_theme(style="whitegrid")
+                    st.session_state['fig'] = Figure(figsize=(8, 3))
+                    st.session_state['ax'] = st.session_state['fig'].subplots()
+                    st.session_state['fig'].patch.set_alpha(0)
+                fig = st.session_state['fig']
+
+                # Hashing only the plotted columns keeps reruns cheap and skips columns
+                # pandas can't hash (LIST/STRUCT results come back as arrays)
+                chart_key = (_df_key(df[plot_cols]), chart_type, x_col, y_col, hue_col)
+                if st.session_state.get('chart_key') != chart_key:
+                    st.session_state['chart_key'] = None  # stays unset if drawing fails
+                    st.session_state['chart_note'] = _render_chart(st.session_state['ax'], df, chart_type, x_col, y_col, hue_col)
+                    st.session_state['chart_key'] = chart_key
+
                 st.pyplot(fig, use_container_width=False)
+                if st.session_state['chart_note']:
+                    st.caption(st.session_state['chart_note'])
 
             except Exception as e:
                 st.warning(f"Could not render {chart_type}: {e}")
\ No newline at end of file